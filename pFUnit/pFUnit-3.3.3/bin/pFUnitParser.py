@@ -20,30 +20,93 @@ assertVariants = 'Fail|Equal|True|False|LessThan|LessThanOrEqual|GreaterThan'
 assertVariants += '|GreaterThanOrEqual|IsMemberOf|Contains|Any|All|NotAll|None'
 assertVariants += '|IsPermutationOf|ExceptionRaised|SameShape|IsNaN|IsFinite'
 
-
-def cpp_set_line(line, filename):
-    return "#line " + str(line) + ' "' + filename + '"\n'
+# All patterns are compiled once at import time (or in the Action
+# constructors for the keyword-parameterized ones) so that the per-line
+# hot loop avoids repeated lookups in re's internal pattern cache.
+reSubroutine = re.compile('\s*subroutine\s+(\w*)\s*(\\([\w\s,]*\\))?\s*(!.*)*$',
+                          re.IGNORECASE)
+reSelfObject = re.compile('\s*subroutine\s+\w*\s*\\(\s*(\w+)\s*(,\s*\w+\s*)*\\)\s*$',
+                          re.IGNORECASE)
+reTypeName = re.compile('\s*type(.*::\s*|\s+)(\w*)\s*$', re.IGNORECASE)
+reMessage = re.compile('.*message=.*', re.IGNORECASE)
+
+reTestCase = re.compile('\s*@testcase\s*(?:\\((.*)\\))?\s*$', re.IGNORECASE)
+reSuite = re.compile("\s*@suite\s*\\(\s*name\s*=\s*('\w+'|" + """\w+)\s*\\)\s*$""",
+                     re.IGNORECASE)
+reModule = re.compile('\s*module\s+(\w*)\s*$', re.IGNORECASE)
+reBefore = re.compile('\s*@before\s*$', re.IGNORECASE)
+reAfter = re.compile('\s*@after\s*$', re.IGNORECASE)
+reTestParameter = re.compile('\s*@testParameter\s*(?:\\((.*)\\)\s*$)?.*$',
+                             re.IGNORECASE)
+
+# Extracts the keyword that selects which action (if any) can handle a
+# candidate line, for the dispatch table built in Parser.__init__.
+reLeadToken = re.compile('(@\w+|module)\\b', re.IGNORECASE)
+
+reConstructor = re.compile('constructor\s*=\s*(\w*)', re.IGNORECASE)
+# Matches one "keyword=value" pair in a directive option list, where the
+# value is a [...] list, a {...} expression, or a bare word.  One findall
+# with this pattern replaces a separate search per recognized keyword.
+reOption = re.compile('(\w+)\s*=\s*(\\[[^\\]]*\\]|[{].*[}]|\w+)',
+                      re.IGNORECASE)
+
+# The alternation over all assert variants yields a long pattern; build it
+# once here rather than once per Action instance.
+reAssert = re.compile('\s*@assert(' + assertVariants + ')\s*\\((.*\w.*)\\)\s*$',
+                      re.IGNORECASE)
+reMpiAssert = re.compile('\s*@mpiassert(' + assertVariants
+                         + ')\s*\\((.*\w.*)\\)\s*$', re.IGNORECASE)
+
+# One pattern per directive suffices for every argument count, since the
+# actions re-split the parenthesized body with parseDirectiveArguments
+# anyway; the two- and three-argument fallback patterns are gone.
+reAssertAssociated = re.compile('\s*@assertassociated\s*\\((.*\w.*)\\)\s*$',
+                                re.IGNORECASE)
+reAssertNotAssociated = re.compile(
+    '\s*@assert(not|un)associated\s*\\((.*\w.*)\\)\s*$', re.IGNORECASE)
+reAssertEqualUserDefined = re.compile(
+    '\s*@assertequaluserdefined\s*\\(\s*([^,]*\w.*),\s*(.*\w.*)\\)\s*$',
+    re.IGNORECASE)
+reAssertEquivalent = re.compile(
+    '\s*@assertequivalent\s*\\(\s*([^,]*\w.*),\s*(.*\w.*)\\)\s*$',
+    re.IGNORECASE)
+
+_parenArgsPatterns = {}
+
+
+def parenArgsPattern(directiveName):
+    '''
+    Returns the compiled "directive(args)" pattern for the given directive,
+    compiling it on first use and caching it for subsequent calls.
+    '''
+    try:
+        return _parenArgsPatterns[directiveName]
+    except KeyError:
+        pattern = re.compile('\s*'+directiveName+'\s*\\((.*\w.*)\\)\s*$',
+                             re.IGNORECASE)
+        _parenArgsPatterns[directiveName] = pattern
+        return pattern
 
 
-def compiler_set_line(line, filename=None):
+def parseNpesList(value):
     '''
-    Returns a string holding a linemarker as understood by compilers.
-
-    Currently the flags which may appear in such a linemarker are not
-    supported. These are mostly related to #include debris so are of low
-    priority at the moment.
+    Returns the list of process counts requested by an npes option value,
+    preformatted as strings, or None if the value is not a bracketed list
+    of integers.  Anything else (a bare word, a stray variable inside the
+    brackets) is not a valid npes request and is ignored by the caller,
+    exactly as the historic digits-only npes pattern did.
     '''
-    linemarker = '#' + str(line)
-    if filename:
-        linemarker += ' "' + filename + '"'
-    linemarker += '\n'
-    return linemarker
+    if value[:1] != '[':
+        return None
+    entries = [x.strip() for x in value[1:-1].split(',') if x.strip()]
+    if not entries or not all(x.isdigit() for x in entries):
+        return None
+    return [str(int(x)) for x in entries]
 
 
 def getSubroutineName(line):
     try:
-        m = re.match('\s*subroutine\s+(\w*)\s*(\\([\w\s,]*\\))?\s*(!.*)*$',
-                     line, re.IGNORECASE)
+        m = reSubroutine.match(line)
         return m.groups()[0]
     except Exception:
         raise MyError('Improper format in declaration of test procedure.')
@@ -58,8 +121,7 @@ def parseArgsFirstRest(directiveName, line):
 
     argStr = ''
     if directiveName != '':
-        m = re.match('\s*'+directiveName+'\s*\\((.*\w.*)\\)\s*$',
-                     line, re.IGNORECASE)
+        m = parenArgsPattern(directiveName).match(line)
         if m:
             argStr = m.groups()[0]
         else:
@@ -84,26 +146,26 @@ def parseArgsFirstSecondRest(directiveName, line):
     If the @-directive must have at least two arguments, parse into first,
     second, and rest strings. Added for assertAssociated.
     """
-    args1 = parseArgsFirstRest(directiveName, line)
-
-    returnArgs = None
-
-    if args1 is not None:
-        if len(args1) == 1:
-            returnArgs = args1
-        elif len(args1) == 2:
-            args2 = parseArgsFirstRest('', args1[1])
-            returnArgs = [args1[0]] + args2
-        elif len(args1) == 3:
-            print(-999, 'parseArgsFirstSecondRest::error!')
-            returnArgs = None
+    if directiveName != '':
+        m = parenArgsPattern(directiveName).match(line)
+        if not m:
+            return None
+        args = parseDirectiveArguments(m.groups()[0])
+    else:
+        args = parseDirectiveArguments(line)
 
-    return returnArgs
+    if not args:
+        return None
+    elif len(args) == 1:
+        return [args[0]]
+    elif len(args) == 2:
+        return [args[0], args[1]]
+    else:
+        return [args[0], args[1], ','.join(args[2:])]
 
 
 def getSelfObjectName(line):
-    m = re.match('\s*subroutine\s+\w*\s*\\(\s*(\w+)\s*(,\s*\w+\s*)*\\)\s*$',
-                 line, re.IGNORECASE)
+    m = reSelfObject.match(line)
     if m:
         return m.groups()[0]
     else:
@@ -111,7 +173,7 @@ def getSelfObjectName(line):
 
 
 def getTypeName(line):
-    m = re.match('\s*type(.*::\s*|\s+)(\w*)\s*$', line, re.IGNORECASE)
+    m = reTypeName.match(line)
     return m.groups()[1]
 
 
@@ -128,69 +190,55 @@ class AtTest(Action):
     def __init__(self, parser):
         self.parser = parser
         self.keyword = '@test'
+        self.re_match = re.compile('\s*'+self.keyword+'\s*(?:\\((.*)\\))?\s*$',
+                                   re.IGNORECASE)
 
     def match(self, line):
-        m = re.match('\s*'+self.keyword+'(\s*(\\(.*\\))?\s*$)',
-                     line, re.IGNORECASE)
+        m = self.re_match.match(line)
         return m
 
     def action(self, m, line):
-        options = re.match('\s*'+self.keyword+'\s*\\((.*)\\)\s*$',
-                           line, re.IGNORECASE)
+        options = m.groups()[0]
         method = {}
 
-        if options:
-
-            npesOption = re.search('npes\s*=\s*\\[([0-9,\s]+)\\]',
-                                   options.groups()[0], re.IGNORECASE)
-            if npesOption:
-                npesString = npesOption.groups()[0]
-                npes = map(int, npesString.split(','))
-                method['npRequests'] = npes
-
-            # ifdef is optional
-            matchIfdef = re.match('.*ifdef\s*=\s*(\w+)',
-                                  options.groups()[0], re.IGNORECASE)
-            if matchIfdef:
-                ifdef = matchIfdef.groups()[0]
-                method['ifdef'] = ifdef
-
-            matchIfndef = re.match('.*ifndef\s*=\s*(\w+)',
-                                   options.groups()[0], re.IGNORECASE)
-            if matchIfndef:
-                ifndef = matchIfndef.groups()[0]
-                method['ifndef'] = ifndef
-
-            matchType = re.match('.*type\s*=\s*(\w+)',
-                                 options.groups()[0], re.IGNORECASE)
-            if matchType:
-                print ('Type', matchType.groups()[0])
-                method['type'] = matchType.groups()[0]
-
-            paramOption = re.search('testParameters\s*=\s*[{](.*)[}]',
-                                    options.groups()[0], re.IGNORECASE)
-            if paramOption:
-                paramExpr = paramOption.groups()[0]
-                method['testParameters'] = paramExpr
-
-            casesOption = re.search('cases\s*=\s*(\\[[0-9,\s]+\\])',
-                                    options.groups()[0], re.IGNORECASE)
-            if casesOption:
-                method['cases'] = casesOption.groups()[0]
-
-        nextLine = self.parser.nextLine()
+        if options is not None:
+
+            for keyword, value in reOption.findall(options):
+                keyword = keyword.lower()
+                if keyword == 'npes':
+                    # A real list: the npes request may be iterated more
+                    # than once when the wrapper module is emitted.  A
+                    # malformed value yields None and the option is ignored,
+                    # so the test is still registered.
+                    npes = parseNpesList(value)
+                    if npes is not None:
+                        method['npRequests'] = npes
+                elif keyword == 'ifdef':  # ifdef is optional
+                    method['ifdef'] = value
+                elif keyword == 'ifndef':
+                    method['ifndef'] = value
+                elif keyword == 'type':
+                    print ('Type', value)
+                    method['type'] = value
+                elif keyword == 'testparameters':
+                    method['testParameters'] = value[1:-1]
+                elif keyword == 'cases':
+                    method['cases'] = value
+
+        p = self.parser
+        nextLine = p.nextLine()
         method['name'] = getSubroutineName(nextLine)
         # save "self" name for use with @mpiAssert
-        self.parser.currentSelfObjectName = getSelfObjectName(nextLine)
+        p.currentSelfObjectName = getSelfObjectName(nextLine)
 
         # save "self" name for use with @mpiAssert
         dummyArgument = getSelfObjectName(nextLine)
         if dummyArgument:
             method['selfObjectName'] = dummyArgument
 
-        self.parser.userTestMethods.append(method)
-        self.parser.commentLine(line)
-        self.parser.outputFile.write(nextLine)
+        p.userTestMethods.append(method)
+        p.commentLine(line)
+        p.outputFile.write(nextLine)
 
 
 # ------------------
@@ -199,6 +247,8 @@ class AtMpiTest(AtTest):
     def __init__(self, parser):
         self.parser = parser
         self.keyword = '@mpitest'
+        self.re_match = re.compile('\s*'+self.keyword+'\s*(?:\\((.*)\\))?\s*$',
+                                   re.IGNORECASE)
 
 
 class AtTestCase(Action):
@@ -206,41 +256,31 @@ class AtTestCase(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*@testcase\s*(|\\(.*\\))\s*$', line, re.IGNORECASE)
+        m = reTestCase.match(line)
         return m
 
     def action(self, m, line):
-        options = re.match('\s*@testcase\s*\\((.*)\\)\s*$',
-                           line, re.IGNORECASE)
-        if options:
-            value = re.search('constructor\s*=\s*(\w*)',
-                              options.groups()[0], re.IGNORECASE)
-            if value:
-                self.parser.userTestCase['constructor'] = value.groups()[0]
-
-            value = re.search('npes\s*=\s*\\[([0-9,\s]+)\\]',
-                              options.groups()[0], re.IGNORECASE)
-            if value:
-                npesString = value.groups()[0]
-                npes = map(int, npesString.split(','))
-                self.parser.userTestCase['npRequests'] = npes
-
-            value = re.search('cases\s*=\s*(\\[[0-9,\s]+\\])',
-                              options.groups()[0], re.IGNORECASE)
-            if value:
-                cases = value.groups()[0]
-                self.parser.userTestCase['cases'] = cases
-
-            value = re.search('testParameters\s*=\s*[{](.*)[}]',
-                              options.groups()[0], re.IGNORECASE)
-            if value:
-                paramExpr = value.groups()[0]
-                self.parser.userTestCase['testParameters'] = paramExpr
-
-        nextLine = self.parser.nextLine()
-        self.parser.userTestCase['type'] = getTypeName(nextLine)
-        self.parser.commentLine(line)
-        self.parser.outputFile.write(nextLine)
+        p = self.parser
+        options = m.groups()[0]
+        if options is not None:
+            userTestCase = p.userTestCase
+            for keyword, value in reOption.findall(options):
+                keyword = keyword.lower()
+                if keyword == 'constructor':
+                    userTestCase['constructor'] = value
+                elif keyword == 'npes':
+                    npes = parseNpesList(value)
+                    if npes is not None:
+                        userTestCase['npRequests'] = npes
+                elif keyword == 'cases':
+                    userTestCase['cases'] = value
+                elif keyword == 'testparameters':
+                    userTestCase['testParameters'] = value[1:-1]
+
+        nextLine = p.nextLine()
+        p.userTestCase['type'] = getTypeName(nextLine)
+        p.commentLine(line)
+        p.outputFile.write(nextLine)
 
 
 class AtSuite(Action):
@@ -248,9 +288,11 @@ class AtSuite(Action):
         self.parser = parser
 
     def match(self, line):
-        nameRe = "'\w+'|" + """\w+"""
-        m = re.match("\s*@suite\s*\\(\s*name\s*=\s*("+nameRe+")\s*\\)\s*$",
-                     line, re.IGNORECASE)
+        # Cheap rejection first; the full pattern only runs on lines that
+        # really start with the @suite keyword.
+        if not line.lstrip().lower().startswith('@suite'):
+            return None
+        m = reSuite.match(line)
         return m
 
     def action(self, m, line):
@@ -263,7 +305,10 @@ class AtBegin(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*module\s+(\w*)\s*$', line, re.IGNORECASE)
+        # Cheap rejection first; most lines are not a module statement.
+        if not line.lstrip().lower().startswith('module'):
+            return None
+        m = reModule.match(line)
         return m
 
     def action(self, m, line):
@@ -279,259 +324,107 @@ class AtAssert(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*@assert(' + assertVariants + ')\s*\\((.*\w.*)\\)\s*$',
-                     line, re.IGNORECASE)
+        m = reAssert.match(line)
         return m
 
-    def appendSourceLocation(self, fileHandle, fileName, lineNumber):
-        fileHandle.write(" & location=SourceLocation( &\n")
-        fileHandle.write(" & '" + str(basename(fileName)) + "', &\n")
-        fileHandle.write(" & " + str(lineNumber) + ")")
-
     def action(self, m, line):
         p = self.parser
+        setLine = p.setLine
+        lineNumber = p.currentLineNumber
 
-        p.outputFile.write(self.parser.set_line(p.currentLineNumber,
-                                                p.fileName))
-        p.outputFile.write("  call assert" + m.groups()[0]
-                           + "(" + m.groups()[1] + ", &\n")
-        self.appendSourceLocation(p.outputFile,
-                                  p.fileName,
-                                  p.currentLineNumber)
-        p.outputFile.write(" )\n")
-        p.outputFile.write("  if (anyExceptions()) return\n")
-        fragment = self.parser.set_line(p.currentLineNumber+1, p.fileName)
-        p.outputFile.write(fragment)
-
-
-class AtAssertAssociated(Action):
-    def __init__(self, parser):
-        self.parser = parser
-
-    def match(self, line):
-        m = re.match('\s*@assertassociated\s*\\((.*\w.*)\\)\s*$',
-                     line, re.IGNORECASE)
-
-        if not m:
-            m = re.match('\s*@assertassociated\s*\\'
-                         + '((\s*([^,]*\w.*),\s*([^,]*\w.*),(.*\w*.*))\\)\s*$',
-                         line, re.IGNORECASE)
-
-        # How to get both (a,b) and (a,b,c) to match?
-        if not m:
-            m = re.match('\s*@assertassociated\s*\\'
-                         + '((\s*([^,]*\w.*),\s*([^,]*\w.*))\\)\s*$',
-                         line, re.IGNORECASE)
-        return m
+        parts = [setLine(lineNumber),
+                 "  call assert" + m.groups()[0]
+                 + "(" + m.groups()[1] + ", &\n"]
+        parts.append(p.locationPrefix + str(lineNumber) + ")")
+        parts.append(" )\n")
+        parts.append("  if (anyExceptions()) return\n")
+        parts.append(setLine(lineNumber + 1))
+        p.outputFile.write(''.join(parts))
 
-    def appendSourceLocation(self, fileHandle, fileName, lineNumber):
-        fileHandle.write(" & location=SourceLocation( &\n")
-        fileHandle.write(" & '" + str(basename(fileName)) + "', &\n")
-        fileHandle.write(" & " + str(lineNumber) + ")")
 
-    def action(self, m, line):
-        p = self.parser
-
-        # args = parseArgsFirstRest('@assertassociated',line)
-        args = parseArgsFirstSecondRest('@assertassociated', line)
-
-        # print(9000,line)
-        # print(9001,args)
-
-        p.outputFile.write(self.parser.set_line(p.currentLineNumber,
-                                                p.fileName))
-        if len(args) > 1:
-            if re.match('.*message=.*', args[1], re.IGNORECASE):
-                p.outputFile.write("  call assertTrue(associated("
-                                   + args[0] + "), " + args[1] + ", &\n")
-            elif len(args) > 2:
-                p.outputFile.write("  call assertTrue(associated("
-                                   + args[0] + "," + args[1] + "), "
-                                   + args[2] + ", &\n")
-            else:
-                p.outputFile.write("  call assertTrue(associated("
-                                   + args[0] + "," + args[1] + "), &\n")
-        else:
-            p.outputFile.write("  call assertTrue(associated("
-                               + args[0] + "), &\n")
-        self.appendSourceLocation(p.outputFile,
-                                  p.fileName,
-                                  p.currentLineNumber)
-        p.outputFile.write(" )\n")
-        p.outputFile.write("  if (anyExceptions()) return\n")
-        fragment = self.parser.set_line(p.currentLineNumber+1, p.fileName)
-        p.outputFile.write(fragment)
-
-
-class AtAssertNotAssociated(Action):
-    def __init__(self, parser):
-        self.parser = parser
-        self.name = '@assertnotassociated'
-
-    def match(self, line):
-        m = re.match('\s*@assert(not|un)associated\s*\\((.*\w.*)\\)\s*$',
-                     line, re.IGNORECASE)
-        if m:
-            self.name = '@assert' + m.groups()[0] + 'associated'
+def associatedExpression(args):
+    """
+    Returns the tested expression and optional message for the
+    @assertAssociated/@assertNotAssociated family.
+    """
+    if len(args) > 1:
+        if reMessage.match(args[1]):
+            return 'associated(' + args[0] + ')', args[1]
+        elif len(args) > 2:
+            return 'associated(' + args[0] + ',' + args[1] + ')', args[2]
         else:
-            self.name = '@assertnotassociated'
+            return 'associated(' + args[0] + ',' + args[1] + ')', None
+    else:
+        return 'associated(' + args[0] + ')', None
 
-        if not m:
-            m = re.match('\s*@assert(not|un)associated\s*\\'
-                         + '((\s*([^,]*\w.*),\s*([^,]*\w.*),(.*\w*.*))\\)\s*$',
-                         line, re.IGNORECASE)
 
-        # How to get both (a,b) and (a,b,c) to match?
-        if not m:
-            m = re.match('\s*@assert(not|un)associated\s*\\'
-                         + '((\s*([^,]*\w.*),\s*([^,]*\w.*))\\)\s*$',
-                         line, re.IGNORECASE)
+def equalUserDefinedExpression(args):
+    return args[0] + '==' + args[1], args[2] if len(args) > 2 else None
 
-        if m:
-            self.name = '@assert' + m.groups()[0] + 'associated'
-        else:
-            self.name = '@assertnotassociated'
 
-        return m
-
-    def appendSourceLocation(self, fileHandle, fileName, lineNumber):
-        fileHandle.write(" & location=SourceLocation( &\n")
-        fileHandle.write(" & '" + str(basename(fileName)) + "', &\n")
-        fileHandle.write(" & " + str(lineNumber) + ")")
-
-    def action(self, m, line):
-        p = self.parser
+def equivalentExpression(args):
+    return args[0] + '.eqv.' + args[1], args[2] if len(args) > 2 else None
 
-        # -- args = parseArgsFirstRest('@assertassociated',line)
-        # ok args = parseArgsFirstSecondRest('@assertassociated',line)
-        args = parseArgsFirstSecondRest(self.name, line)
 
-        # print(9000,line)
-        # print(9001,args)
-
-        p.outputFile.write(self.parser.set_line(p.currentLineNumber,
-                                                p.fileName))
-        if len(args) > 1:
-            if re.match('.*message=.*', args[1], re.IGNORECASE):
-                p.outputFile.write("  call assertFalse(associated("
-                                   + args[0] + "), " + args[1] + ", &\n")
-            elif len(args) > 2:
-                p.outputFile.write("  call assertFalse(associated("
-                                   + args[0] + "," + args[1] + "), "
-                                   + args[2] + ", &\n")
-            else:
-                p.outputFile.write("  call assertFalse(associated("
-                                   + args[0] + "," + args[1] + "), &\n")
-        else:
-            p.outputFile.write("  call assertFalse(associated("
-                               + args[0] + "), &\n")
-        self.appendSourceLocation(p.outputFile,
-                                  p.fileName,
-                                  p.currentLineNumber)
-        p.outputFile.write(" )\n")
-        p.outputFile.write("  if (anyExceptions()) return\n")
-        fragment = self.parser.set_line(p.currentLineNumber + 1, p.fileName)
-        p.outputFile.write(fragment)
-
-
-class AtAssertEqualUserDefined(Action):
-    """Convenience directive replacing (a,b) with a call to assertTrue(a==b)
-    and an error message, if none is provided when invoked.
+class AssertOp(Action):
+    """Shared action for the convenience assert directives (associated,
+    not/un-associated, equalUserDefined, equivalent), which differ only in
+    the recognizing pattern, the emitted assert call and expression, and
+    whether a default error message is added when none is provided.
     """
-    def __init__(self, parser):
+    def __init__(self, parser, name, pattern, assertName, expression,
+                 defaultMessage=False):
         self.parser = parser
+        self.name = name
+        self.pattern = pattern
+        self.assertName = assertName
+        self.expression = expression
+        self.defaultMessage = defaultMessage
 
     def match(self, line):
-        m = re.match('\s*@assertequaluserdefined\s*\\'
-                     + '((\s*([^,]*\w.*),\s*([^,]*\w.*),(.*\w*.*))\\)\s*$',
-                     line, re.IGNORECASE)
-
-        # How to get both (a,b) and (a,b,c) to match?
-        if not m:
-            m = re.match('\s*@assertequaluserdefined\s*\\'
-                         + '((\s*([^,]*\w.*),\s*([^,]*\w.*))\\)\s*$',
-                         line, re.IGNORECASE)
-
+        m = self.pattern.match(line)
         return m
 
-    def appendSourceLocation(self, fileHandle, fileName, lineNumber):
-        fileHandle.write(" & location=SourceLocation( &\n")
-        fileHandle.write(" & '" + str(basename(fileName)) + "', &\n")
-        fileHandle.write(" & " + str(lineNumber) + ")")
-
     def action(self, m, line):
         p = self.parser
+        setLine = p.setLine
+        lineNumber = p.currentLineNumber
 
-        args = parseArgsFirstSecondRest('@assertequaluserdefined', line)
+        args = parseArgsFirstSecondRest(self.name, line)
+        expression, message = self.expression(args)
 
-        p.outputFile.write(self.parser.set_line(p.currentLineNumber,
-                                                p.fileName))
-        if len(args) > 2:
-            p.outputFile.write("  call assertTrue(" + args[0]
-                               + "==" + args[1] + ", " + args[2] + ", &\n")
+        parts = [setLine(lineNumber)]
+        if message:
+            parts.append(''.join(("  call ", self.assertName, "(",
+                                  expression, ", ", message, ", &\n")))
         else:
-            p.outputFile.write("  call assertTrue(" + args[0]
-                               + "==" + args[1] + ", &\n")
-        if not re.match('.*message=.*', line, re.IGNORECASE):
-            p.outputFile.write(" & message='<" + args[0]
-                               + "> not equal to <" + args[1] + ">', &\n")
-        self.appendSourceLocation(p.outputFile,
-                                  p.fileName,
-                                  p.currentLineNumber)
-        p.outputFile.write(" )\n")
-        p.outputFile.write("  if (anyExceptions()) return\n")
-        fragment = self.parser.set_line(p.currentLineNumber + 1, p.fileName)
-        p.outputFile.write(fragment)
-
-
-class AtAssertEquivalent(Action):
-    """Convenience directive replacing (a,b) with a call to assertTrue(a.eqv.b)
-    and an error message, if none is provided when invoked.
-    """
+            parts.append(''.join(("  call ", self.assertName, "(",
+                                  expression, ", &\n")))
+        if self.defaultMessage and not reMessage.match(line):
+            parts.append(''.join((" & message='<", args[0],
+                                  "> not equal to <", args[1], ">', &\n")))
+        parts.append(p.locationPrefix + str(lineNumber) + ")")
+        parts.append(" )\n")
+        parts.append("  if (anyExceptions()) return\n")
+        parts.append(setLine(lineNumber + 1))
+        p.outputFile.write(''.join(parts))
+
+
+class AtAssertNotAssociated(AssertOp):
     def __init__(self, parser):
-        self.parser = parser
+        AssertOp.__init__(self, parser, '@assertnotassociated',
+                          reAssertNotAssociated, 'assertFalse',
+                          associatedExpression)
 
     def match(self, line):
-        m = re.match('\s*@assertequivalent\s*\\'
-                     + '((\s*([^,]*\w.*),\s*([^,]*\w.*),(.*\w*.*))\\)\s*$',
-                     line, re.IGNORECASE)
-
-        # How to get both (a,b) and (a,b,c) to match?
-        if not m:
-            m = re.match('\s*@assertequivalent\s*\\'
-                         + '((\s*([^,]*\w.*),\s*([^,]*\w.*))\\)\s*$',
-                         line, re.IGNORECASE)
-
-        return m
-
-    def appendSourceLocation(self, fileHandle, fileName, lineNumber):
-        fileHandle.write(" & location=SourceLocation( &\n")
-        fileHandle.write(" & '" + str(basename(fileName)) + "', &\n")
-        fileHandle.write(" & " + str(lineNumber) + ")")
-
-    def action(self, m, line):
-        p = self.parser
-
-        args = parseArgsFirstSecondRest('@assertequivalent', line)
-
-        p.outputFile.write(self.parser.set_line(p.currentLineNumber,
-                                                p.fileName))
-        if len(args) > 2:
-            p.outputFile.write("  call assertTrue(" + args[0]
-                               + ".eqv." + args[1] + ", " + args[2] + ", &\n")
+        m = self.pattern.match(line)
+        if m:
+            # Both the @assertNotAssociated and @assertUnAssociated
+            # spellings are accepted; remember which one matched.
+            self.name = '@assert' + m.groups()[0] + 'associated'
         else:
-            p.outputFile.write("  call assertTrue(" + args[0]
-                               + ".eqv." + args[1] + ", &\n")
-        if not re.match('.*message=.*', line, re.IGNORECASE):
-            p.outputFile.write(" & message='<" + args[0]
-                               + "> not equal to <" + args[1] + ">', &\n")
-        self.appendSourceLocation(p.outputFile,
-                                  p.fileName,
-                                  p.currentLineNumber)
-        p.outputFile.write(" )\n")
-        p.outputFile.write("  if (anyExceptions()) return\n")
-        fragment = self.parser.set_line(p.currentLineNumber + 1, p.fileName)
-        p.outputFile.write(fragment)
+            self.name = '@assertnotassociated'
+        return m
 
 
 class AtMpiAssert(Action):
@@ -539,35 +432,27 @@ class AtMpiAssert(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*@mpiassert('
-                     + assertVariants
-                     + ')\s*\\((.*\w.*)\\)\s*$', line, re.IGNORECASE)
+        m = reMpiAssert.match(line)
         return m
 
-    def appendSourceLocation(self, fileHandle, fileName, lineNumber):
-        fileHandle.write(" & location=SourceLocation( &\n")
-        fileHandle.write(" & '" + str(basename(fileName)) + "', &\n")
-        fileHandle.write(" & " + str(lineNumber) + ")")
-
     def action(self, m, line):
         p = self.parser
+        setLine = p.setLine
+        lineNumber = p.currentLineNumber
 
-        p.outputFile.write(self.parser.set_line(p.currentLineNumber,
-                                                p.fileName))
-        p.outputFile.write("  call assert"
-                           + m.groups()[0] + "(" + m.groups()[1] + ", &\n")
-        self.appendSourceLocation(p.outputFile,
-                                  p.fileName,
-                                  p.currentLineNumber)
-        p.outputFile.write(" )\n")
+        parts = [setLine(lineNumber),
+                 "  call assert"
+                 + m.groups()[0] + "(" + m.groups()[1] + ", &\n"]
+        parts.append(p.locationPrefix + str(lineNumber) + ")")
+        parts.append(" )\n")
 
         # 'this' object may not exist if test is commented out.
         if hasattr(p, 'currentSelfObjectName'):
-            p.outputFile.write("  if (anyExceptions("
-                               + p.currentSelfObjectName
-                               + "%context)) return\n")
-        fragment = self.parser.set_line(p.currentLineNumber + 1, p.fileName)
-        p.outputFile.write(fragment)
+            parts.append("  if (anyExceptions("
+                         + p.currentSelfObjectName
+                         + "%context)) return\n")
+        parts.append(setLine(lineNumber + 1))
+        p.outputFile.write(''.join(parts))
 
 
 class AtBefore(Action):
@@ -575,14 +460,15 @@ class AtBefore(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*@before\s*$', line, re.IGNORECASE)
+        m = reBefore.match(line)
         return m
 
     def action(self, m, line):
-        nextLine = self.parser.nextLine()
-        self.parser.userTestCase['setUp'] = getSubroutineName(nextLine)
-        self.parser.commentLine(line)
-        self.parser.outputFile.write(nextLine)
+        p = self.parser
+        nextLine = p.nextLine()
+        p.userTestCase['setUp'] = getSubroutineName(nextLine)
+        p.commentLine(line)
+        p.outputFile.write(nextLine)
 
 
 class AtAfter(Action):
@@ -590,14 +476,15 @@ class AtAfter(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*@after\s*$', line, re.IGNORECASE)
+        m = reAfter.match(line)
         return m
 
     def action(self, m, line):
-        nextLine = self.parser.nextLine()
-        self.parser.userTestCase['tearDown'] = getSubroutineName(nextLine)
-        self.parser.commentLine(line)
-        self.parser.outputFile.write(nextLine)
+        p = self.parser
+        nextLine = p.nextLine()
+        p.userTestCase['tearDown'] = getSubroutineName(nextLine)
+        p.commentLine(line)
+        p.outputFile.write(nextLine)
 
 
 class AtTestParameter(Action):
@@ -605,29 +492,53 @@ class AtTestParameter(Action):
         self.parser = parser
 
     def match(self, line):
-        m = re.match('\s*@testParameter\s*(|.*)$', line, re.IGNORECASE)
+        m = reTestParameter.match(line)
         return m
 
     def action(self, m, line):
-        options = re.match('\s*@testParameter\s*\\((.*)\\)\s*$',
-                           line, re.IGNORECASE)
-
-        self.parser.commentLine(line)
-        nextLine = self.parser.nextLine()
-        if 'testParameterType' not in self.parser.userTestCase:
-            self.parser.userTestCase['testParameterType'] \
-                = getTypeName(nextLine)
-        self.parser.outputFile.write(nextLine)
-
-        if options:
-            value = re.search('constructor\s*=\s*(\w*)',
-                              options.groups()[0], re.IGNORECASE)
+        p = self.parser
+        options = m.groups()[0]
+
+        p.commentLine(line)
+        nextLine = p.nextLine()
+        if 'testParameterType' not in p.userTestCase:
+            p.userTestCase['testParameterType'] = getTypeName(nextLine)
+        p.outputFile.write(nextLine)
+
+        if options is not None:
+            value = reConstructor.search(options)
             if value:
-                self.parser.userTestCase['testParameterConstructor'] \
+                p.userTestCase['testParameterConstructor'] \
                     = value.groups()[0]
             else:
-                self.parser.userTestCase['testParameterConstructor'] \
-                    = self.parser.userTestCase['testParameterType']
+                p.userTestCase['testParameterConstructor'] \
+                    = p.userTestCase['testParameterType']
+
+
+# The makeCustomTest function only varies in its argument list, the
+# optional testParameter declaration, the optional constructor call and
+# the optional setTestParameter call; everything else is this fixed text.
+makeCustomTestTemplate = '''\
+   function makeCustomTest({args}) result(aTest)
+#ifdef INTEL_13
+      use pfunit_mod, only: testCase
+#endif
+      type (WrapUserTestCase) :: aTest
+#ifdef INTEL_13
+      target :: aTest
+      class (WrapUserTestCase), pointer :: p
+#endif
+      character(len=*), intent(in) :: methodName
+      procedure(userTestMethod) :: testMethod
+{testParameterDecl}{constructorLine}      aTest%testMethodPtr => testMethod
+#ifdef INTEL_13
+      p => aTest
+      call p%setName(methodName)
+#else
+      call aTest%setName(methodName)
+#endif
+{setTestParameterLine}   end function makeCustomTest
+'''
 
 
 class Parser():
@@ -637,14 +548,33 @@ class Parser():
             base = basename(fileName)
             return splitext(base)[0]
 
+        # use_markers selects compiler-style linemarkers ('#<n> "file"')
+        # over cpp-style '#line <n> "file"' directives; the flags that may
+        # appear in a linemarker (mostly #include debris) are not emitted.
         if use_markers:
-            self.set_line = compiler_set_line
+            self.linePrefix = '#'
         else:
-            self.set_line = cpp_set_line
+            self.linePrefix = '#line '
+        # The file name part of every #line/linemarker directive is fixed,
+        # so setLine() only has to substitute the line number between these.
+        self.lineSuffix = ' "' + inputFileName + '"\n'
 
         self.fileName = inputFileName
-        self.inputFile = open(inputFileName, 'r')
-        self.outputFile = open(outputFileName, 'w')
+        # The file name never changes during a run, so the constant part of
+        # the SourceLocation continuation emitted with every assertion is
+        # built once here.
+        self.locationPrefix = " & location=SourceLocation( &\n & '" \
+                              + basename(inputFileName) + "', &\n & "
+        # Slurp the whole input up front; .pf files are small and indexing
+        # a list is much cheaper than a readline call per source line.  The
+        # descriptor is released immediately instead of staying open for
+        # the whole run.
+        with open(inputFileName, 'r') as inputFile:
+            self.lines = inputFile.readlines()
+        self.numLines = len(self.lines)
+        # A large write buffer keeps the many small emitted fragments from
+        # turning into individual OS writes on slow filesystems.
+        self.outputFile = open(outputFileName, 'w', buffering=1 << 20)
         self.defaultSuiteName = getBaseName(inputFileName) + "_suite"
         self.suiteName = ''
 
@@ -664,39 +594,96 @@ class Parser():
         self.wrapModuleName = "Wrap" + getBaseName(inputFileName)
         self.currentLineNumber = 0
 
-        self.actions = []
-        self.actions.append(AtTest(self))
-        self.actions.append(AtMpiTest(self))
-        self.actions.append(AtTestCase(self))
-        self.actions.append(AtSuite(self))
-        self.actions.append(AtBegin(self))
-
-        self.actions.append(AtAssert(self))
-        self.actions.append(AtAssertAssociated(self))
-#        self.actions.append(AtAssertAssociatedWith(self))
-        self.actions.append(AtAssertNotAssociated(self))
-#        self.actions.append(AtAssertNotAssociatedWith(self))
-
-        self.actions.append(AtAssertEqualUserDefined(self))
-        self.actions.append(AtAssertEquivalent(self))
-
-        self.actions.append(AtMpiAssert(self))
-        self.actions.append(AtBefore(self))
-        self.actions.append(AtAfter(self))
-        self.actions.append(AtTestParameter(self))
+        atTest = AtTest(self)
+        atMpiTest = AtMpiTest(self)
+        atTestCase = AtTestCase(self)
+        atSuite = AtSuite(self)
+        atBegin = AtBegin(self)
+
+        atAssert = AtAssert(self)
+        atAssertAssociated = AssertOp(self, '@assertassociated',
+                                      reAssertAssociated, 'assertTrue',
+                                      associatedExpression)
+        atAssertNotAssociated = AtAssertNotAssociated(self)
+
+        atAssertEqualUserDefined = AssertOp(self, '@assertequaluserdefined',
+                                            reAssertEqualUserDefined,
+                                            'assertTrue',
+                                            equalUserDefinedExpression,
+                                            defaultMessage=True)
+        atAssertEquivalent = AssertOp(self, '@assertequivalent',
+                                      reAssertEquivalent, 'assertTrue',
+                                      equivalentExpression,
+                                      defaultMessage=True)
+
+        atMpiAssert = AtMpiAssert(self)
+        atBefore = AtBefore(self)
+        atAfter = AtAfter(self)
+        atTestParameter = AtTestParameter(self)
+
+        self.actions = [atTest, atMpiTest, atTestCase, atSuite, atBegin,
+                        atAssert, atAssertAssociated, atAssertNotAssociated,
+                        atAssertEqualUserDefined, atAssertEquivalent,
+                        atMpiAssert, atBefore, atAfter, atTestParameter]
+
+        # Map the lowercased leading keyword of a candidate line directly to
+        # the one action that can match it, so that dispatch in run() is a
+        # single dict lookup followed by at most one validating regex.  The
+        # generic assert directives get one entry per assert variant.
+        self.dispatchTable = {'@test': atTest,
+                              '@mpitest': atMpiTest,
+                              '@testcase': atTestCase,
+                              '@suite': atSuite,
+                              'module': atBegin,
+                              '@assertassociated': atAssertAssociated,
+                              '@assertnotassociated': atAssertNotAssociated,
+                              '@assertunassociated': atAssertNotAssociated,
+                              '@assertequaluserdefined':
+                              atAssertEqualUserDefined,
+                              '@assertequivalent': atAssertEquivalent,
+                              '@before': atBefore,
+                              '@after': atAfter,
+                              '@testparameter': atTestParameter}
+        for variant in assertVariants.split('|'):
+            self.dispatchTable['@assert' + variant.lower()] = atAssert
+            self.dispatchTable['@mpiassert' + variant.lower()] = atMpiAssert
+
+        # Pre-bind the match/action pair of each entry so the dispatch in
+        # run() skips the Action.apply frame and its two attribute lookups.
+        self.dispatchTable = dict((keyword, (action.match, action.action))
+                                  for keyword, action
+                                  in self.dispatchTable.items())
+
+    def setLine(self, lineNumber):
+        return self.linePrefix + str(lineNumber) + self.lineSuffix
 
     def commentLine(self, line):
-        self.outputFile.write(re.sub('@', '!@', line))
+        # Only the leading '@' of a directive line needs to be commented out.
+        self.outputFile.write(line.replace('@', '!@', 1))
 
     def run(self):
+        # Hoist the attribute lookups out of the per-line loop; this is the
+        # hottest code in the preprocessor.
+        dispatchTable = self.dispatchTable
+        nextLine = self.nextLine
+        write = self.outputFile.write
+
         def parse(line):
-            for action in self.actions:
-                if (action.apply(line)):
-                    return
-            self.outputFile.write(line)
+            stripped = line.lstrip()
+            if stripped and (stripped[0] == '@' or stripped[0] in 'mM'):
+                token = reLeadToken.match(stripped)
+                if token:
+                    entry = dispatchTable.get(token.groups()[0].lower())
+                    if entry:
+                        match, action = entry
+                        m = match(line)
+                        if m:
+                            action(m, line)
+                            return
+            write(line)
 
         while True:
-            line = self.nextLine()
+            line = nextLine()
             if not line:
                 break
             parse(line)
@@ -710,102 +697,106 @@ class Parser():
         self.makeWrapperModule()
 
     def isComment(self, line):
-        return re.match('\s*(!.*|)$', line)
+        # Cheaper than a regex for "blank or '!'-comment", and this is
+        # called once for every input line.
+        stripped = line.lstrip()
+        return not stripped or stripped[0] == '!'
 
     def nextLine(self):
+        lines = self.lines
+        numLines = self.numLines
+        write = self.outputFile.write
+        lineNumber = self.currentLineNumber
+        line = ''
         while True:
-            self.currentLineNumber += 1
-            line = self.inputFile.readline()
-            if not line:
+            lineNumber += 1
+            if lineNumber > numLines:
                 break
+            line = lines[lineNumber - 1]
             if (self.isComment(line)):
-                self.outputFile.write(line)
-                pass
+                write(line)
+                line = ''
             else:
                 break
+        self.currentLineNumber = lineNumber
         return line
 
     def printHeader(self):
-        self.outputFile.write('\n')
-        self.outputFile.write('module ' + self.wrapModuleName + '\n')
-        self.outputFile.write('   use pFUnit_mod\n')
+        useUserModule = ''
         if (self.userModuleName):
-            self.outputFile.write('   use ' + self.userModuleName + '\n')
-        self.outputFile.write('   implicit none\n')
-        self.outputFile.write('   private\n\n')
+            useUserModule = '   use ' + self.userModuleName + '\n'
+        self.outputFile.write('\n'
+                              + 'module ' + self.wrapModuleName + '\n'
+                              + '   use pFUnit_mod\n'
+                              + useUserModule
+                              + '   implicit none\n'
+                              + '   private\n\n')
 
     def printTail(self):
-        self.outputFile.write('\n')
-        self.outputFile.write('end module ' + self.wrapModuleName + '\n\n')
+        self.outputFile.write('\nend module ' + self.wrapModuleName + '\n\n')
 
     def printWrapUserTestCase(self):
-        self.outputFile.write('   public :: WrapUserTestCase\n')
-        self.outputFile.write('   public :: makeCustomTest\n')
-        self.outputFile.write('   type, extends('
-                              + self.userTestCase['type']
-                              + ') :: WrapUserTestCase\n')
-        fragment = '      procedure(userTestMethod), ' \
-                   + 'nopass, pointer :: testMethodPtr\n'
-        self.outputFile.write(fragment)
-        self.outputFile.write('   contains\n')
-        self.outputFile.write('      procedure :: runMethod\n')
-        self.outputFile.write('   end type WrapUserTestCase\n\n')
-
-        self.outputFile.write('   abstract interface\n')
-        self.outputFile.write('     subroutine userTestMethod(this)\n')
+        parts = ['   public :: WrapUserTestCase\n',
+                 '   public :: makeCustomTest\n',
+                 '   type, extends(' + self.userTestCase['type']
+                 + ') :: WrapUserTestCase\n',
+                 '      procedure(userTestMethod), '
+                 'nopass, pointer :: testMethodPtr\n',
+                 '   contains\n',
+                 '      procedure :: runMethod\n',
+                 '   end type WrapUserTestCase\n\n',
+                 '   abstract interface\n',
+                 '     subroutine userTestMethod(this)\n']
         if self.userModuleName:
-            self.outputFile.write('        use ' + self.userModuleName + '\n')
+            parts.append('        use ' + self.userModuleName + '\n')
         if 'type' in self.userTestCase:
-            self.outputFile.write('        class ('
-                                  + self.userTestCase['type']
-                                  + '), intent(inout) :: this\n')
-        self.outputFile.write('     end subroutine userTestMethod\n')
-        self.outputFile.write('   end interface\n\n')
+            parts.append('        class (' + self.userTestCase['type']
+                         + '), intent(inout) :: this\n')
+        parts.append('     end subroutine userTestMethod\n')
+        parts.append('   end interface\n\n')
+        self.outputFile.write(''.join(parts))
 
     def printRunMethod(self):
-        self.outputFile.write('   subroutine runMethod(this)\n')
-        fragment = '      class (WrapUserTestCase), intent(inout) :: this\n\n'
-        self.outputFile.write(fragment)
-        self.outputFile.write('      call this%testMethodPtr(this)\n')
-        self.outputFile.write('   end subroutine runMethod\n\n')
+        self.outputFile.write(
+            '   subroutine runMethod(this)\n'
+            '      class (WrapUserTestCase), intent(inout) :: this\n\n'
+            '      call this%testMethodPtr(this)\n'
+            '   end subroutine runMethod\n\n')
 
     def printParameterHeader(self, type):
-        self.outputFile.write('   type ('
-                              + type + '), allocatable :: testParameters(:)\n')
-        self.outputFile.write('   type (' + type + ') :: testParameter\n')
-        self.outputFile.write('   integer :: iParam \n')
-        self.outputFile.write('   integer, allocatable :: cases(:) \n')
-        self.outputFile.write(' \n')
+        self.outputFile.write('   type (' + type
+                              + '), allocatable :: testParameters(:)\n'
+                              + '   type (' + type + ') :: testParameter\n'
+                              + '   integer :: iParam \n'
+                              + '   integer, allocatable :: cases(:) \n'
+                              + ' \n')
 
     def printMakeSuite(self):
-        self.outputFile.write('function '
-                              + self.suiteName + '() result(suite)\n')
-        self.outputFile.write('   use pFUnit_mod\n')
+        parts = ['function ' + self.suiteName + '() result(suite)\n',
+                 '   use pFUnit_mod\n']
         if (self.userModuleName):
-            self.outputFile.write('   use ' + self.userModuleName + '\n')
-        self.outputFile.write('   use ' + self.wrapModuleName + '\n')
-        self.outputFile.write('   type (TestSuite) :: suite\n\n')
+            parts.append('   use ' + self.userModuleName + '\n')
+        parts.append('   use ' + self.wrapModuleName + '\n')
+        parts.append('   type (TestSuite) :: suite\n\n')
 
         if not self.userModuleName:
             for testMethod in self.userTestMethods:
                 if ('ifdef' in testMethod):
-                    self.outputFile.write('#ifdef '
-                                          + testMethod['ifdef'] + '\n')
+                    parts.append('#ifdef ' + testMethod['ifdef'] + '\n')
                 elif ('ifndef' in testMethod):
-                    self.outputFile.write('#ifndef '
-                                          + testMethod['ifndef'] + '\n')
-                self.outputFile.write('   external '
-                                      + testMethod['name'] + '\n')
+                    parts.append('#ifndef ' + testMethod['ifndef'] + '\n')
+                parts.append('   external ' + testMethod['name'] + '\n')
                 if ('ifdef' in testMethod or 'ifndef' in testMethod):
-                    self.outputFile.write('#endif\n')
-            self.outputFile.write('\n')
+                    parts.append('#endif\n')
+            parts.append('\n')
             if 'setUp' in self.userTestCase:
-                self.outputFile.write('   external '
-                                      + self.userTestCase['setUp'] + '\n')
+                parts.append('   external '
+                             + self.userTestCase['setUp'] + '\n')
             if 'tearDown' in self.userTestCase:
-                self.outputFile.write('   external '
-                                      + self.userTestCase['tearDown'] + '\n')
-            self.outputFile.write('\n')
+                parts.append('   external '
+                             + self.userTestCase['tearDown'] + '\n')
+            parts.append('\n')
+        self.outputFile.write(''.join(parts))
 
         if 'testParameterType' in self.userTestCase:
             type = self.userTestCase['testParameterType']
@@ -814,193 +805,240 @@ class Parser():
         self.outputFile.write("   suite = newTestSuite('"
                               + self.suiteName + "')\n\n")
 
+        isVanilla = self._isVanilla
+        chunk = []
         for testMethod in self.userTestMethods:
             if ('ifdef' in testMethod):
-                self.outputFile.write('#ifdef ' + testMethod['ifdef'] + '\n')
+                chunk.append('#ifdef ' + testMethod['ifdef'] + '\n')
             elif ('ifndef' in testMethod):
-                self.outputFile.write('#ifndef ' + testMethod['ifndef'] + '\n')
-            if 'type' in self.userTestCase:
-                self.addUserTestMethod(testMethod)
+                chunk.append('#ifndef ' + testMethod['ifndef'] + '\n')
+            if isVanilla:
+                chunk.append(self.addVanillaTestMethod(testMethod))
+            elif 'type' in self.userTestCase:
+                chunk.append(self.addUserTestMethod(testMethod))
             else:
                 if 'npRequests' in testMethod:
-                    self.addMpiTestMethod(testMethod)
+                    chunk.append(self.addMpiTestMethod(testMethod))
                 else:  # vanilla
-                    self.addSimpleTestMethod(testMethod)
-            self.outputFile.write('\n')
+                    chunk.append(self.addSimpleTestMethod(testMethod))
+            chunk.append('\n')
             if ('ifdef' in testMethod or 'ifndef' in testMethod):
-                self.outputFile.write('#endif\n')
+                chunk.append('#endif\n')
+
+        chunk.append('\nend function ' + self.suiteName + '\n\n')
+        self.outputFile.write(''.join(chunk))
 
-        self.outputFile.write('\nend function ' + self.suiteName + '\n\n')
+    def addVanillaTestMethod(self, testMethod):
+        # Fast path for suites without any per-method options; equivalent to
+        # addSimpleTestMethod with every optional branch folded away.
+        name = testMethod['name']
+        return "   call suite%addTest(newTestMethod('" + name + "', " \
+               + name + self._vanillaSuffix
 
     def addSimpleTestMethod(self, testMethod):
         args = "'" + testMethod['name'] + "', " + testMethod['name']
-        if 'setUp' in testMethod:
-            args += ', ' + testMethod['setUp']
-        elif 'setUp' in self.userTestCase:
-            args += ', ' + self.userTestCase['setUp']
-
-        if 'tearDown' in testMethod:
-            args += ', ' + testMethod['tearDown']
-        elif 'tearDown' in self.userTestCase:
-            args += ', ' + self.userTestCase['tearDown']
-
-        if 'type' in testMethod:
-            type = testMethod['type']
+        setUp = testMethod.get('setUp')
+        if setUp is not None:
+            args += ', ' + setUp
         else:
-            type = 'newTestMethod'
+            args += self._defaultSetUpArg
 
-        self.outputFile.write('   call suite%addTest('
-                              + type + '(' + args + '))\n')
+        tearDown = testMethod.get('tearDown')
+        if tearDown is not None:
+            args += ', ' + tearDown
+        else:
+            args += self._defaultTearDownArg
+
+        type = testMethod.get('type', 'newTestMethod')
+
+        return '   call suite%addTest(' + type + '(' + args + '))\n'
 
     def addMpiTestMethod(self, testMethod):
-        for npes in testMethod['npRequests']:
-            args = "'" + testMethod['name'] \
-                   + "', " + testMethod['name'] + ", " + str(npes)
-            if 'setUp' in testMethod:
-                args += ', ' + testMethod['setUp']
-            elif 'setUp' in self.userTestCase:
-                args += ', ' + self.userTestCase['setUp']
-
-            if 'tearDown' in testMethod:
-                args += ', ' + testMethod['tearDown']
-            elif 'tearDown' in self.userTestCase:
-                args += ', ' + self.userTestCase['tearDown']
-
-            if 'type' in testMethod:
-                type = testMethod['type']
-            else:
-                type = 'newMpiTestMethod'
+        # Only the process count varies between iterations; the rest of the
+        # argument list is the same for every npes request.
+        base = "'" + testMethod['name'] + "', " + testMethod['name'] + ", "
+
+        setUp = testMethod.get('setUp')
+        if setUp is not None:
+            suffix = ', ' + setUp
+        else:
+            suffix = self._defaultSetUpArg
+
+        tearDown = testMethod.get('tearDown')
+        if tearDown is not None:
+            suffix += ', ' + tearDown
+        else:
+            suffix += self._defaultTearDownArg
 
-            self.outputFile.write('   call suite%addTest('
-                                  + type + '(' + args + '))\n')
+        type = testMethod.get('type', 'newMpiTestMethod')
+
+        # Compile the whole line into one %-template; the invariant pieces
+        # are escaped so that '%' in the generated Fortran survives.
+        template = ('   call suite%addTest(' + type + '('
+                    + base).replace('%', '%%') \
+            + '%s' + (suffix + '))\n').replace('%', '%%')
+
+        parts = []
+        for npes in testMethod['npRequests']:
+            parts.append(template % npes)
+        return ''.join(parts)
 
     def addUserTestMethod(self, testMethod):
 
         args = "'" + testMethod['name'] + "', " + testMethod['name']
-        if 'npRequests' in testMethod:
-            npRequests = testMethod['npRequests']
-        else:
-            if 'npRequests' in self.userTestCase:
-                npRequests = self.userTestCase['npRequests']
-            else:
-                npRequests = [1]
+        npRequests = testMethod.get('npRequests')
+        if npRequests is None:
+            npRequests = self.userTestCase.get('npRequests', ['1'])
 
-        if 'cases' in testMethod:
-            cases = testMethod['cases']
-        elif 'cases' in self.userTestCase:
-            cases = self.userTestCase['cases']
+        cases = testMethod.get('cases')
+        if cases is None:
+            cases = self.userTestCase.get('cases')
 
+        testParameters = None
         testParameterArg = ''  # unless
+        parts = []
 
-        if 'cases' in locals():
+        if cases is not None:
             testParameterArg = ', testParameter'
-            self.outputFile.write('   cases = ' + testMethod['cases'] + '\n')
-            fragment = '   testParameters = [(' \
-                       + self.userTestCase['testParameterConstructor'] \
-                       + '(cases(iCase)), iCase = 1, size(cases))]\n\n'
-            self.outputFile.write(fragment)
+            parts.append('   cases = ' + testMethod['cases'] + '\n')
+            parts.append('   testParameters = [('
+                         + self.userTestCase['testParameterConstructor']
+                         + '(cases(iCase)), iCase = 1, size(cases))]\n\n')
 
         if 'testParameterType' in self.userTestCase:
-            if 'testParameters' in testMethod:
-                testParameters = testMethod['testParameters']
-            elif 'testParameters' in self.userTestCase:
-                testParameters = self.userTestCase['testParameters']
+            testParameters = testMethod.get('testParameters')
+            if testParameters is None:
+                testParameters = self.userTestCase.get('testParameters')
 
-        found = any('npRequests' in testMethod
-                    for testMethod in self.userTestMethods)
-        isMpiTestCase = 'npRequests' in self.userTestCase
-        isMpiTestCase = isMpiTestCase or found
+        isMpiTestCase = self._isMpiTestCase
 
-        if 'testParameters' in locals():
+        if testParameters is not None:
             testParameterArg = ', testParameter'
-            self.outputFile.write('   testParameters = '
-                                  + testParameters + '\n\n')
+            parts.append('   testParameters = ' + testParameters + '\n\n')
         elif isMpiTestCase:
             testParameterArg = ', testParameter'
 
-        for npes in npRequests:
-
-            if 'testParameters' in locals() or 'cases' in locals():
-                fragment = '   do iParam = 1, size(testParameters)\n'
-                self.outputFile.write(fragment)
-                fragment = '      testParameter = testParameters(iParam)\n'
-                self.outputFile.write(fragment)
+        # Only the setNumProcessesRequested line varies with npes; the
+        # prologue and the addTest call are the same on every iteration.
+        if testParameters is not None or cases is not None:
+            prologue = '   do iParam = 1, size(testParameters)\n' \
+                       '      testParameter = testParameters(iParam)\n'
+            epilogue = '   end do\n'
+        else:
+            prologue = ''
+            epilogue = ''
+        addTestLine = '   call suite%addTest(makeCustomTest(' \
+                      + args + testParameterArg + '))\n'
+
+        if isMpiTestCase:
+            # Compile the per-npes block into one %-template; the invariant
+            # pieces are escaped so that '%' in the generated Fortran
+            # survives the formatting.
+            template = prologue \
+                + '   call testParameter%setNumProcessesRequested('.replace(
+                    '%', '%%') \
+                + '%s' + (')\n' + addTestLine + epilogue).replace('%', '%%')
+            for npes in npRequests:
+                parts.append(template % npes)
+        else:
+            block = prologue + addTestLine + epilogue
+            parts.extend([block] * len(npRequests))
 
-            if isMpiTestCase:
-                fragment = '   call testParameter%setNumProcessesRequested(' \
-                           + str(npes) + ')\n'
-                self.outputFile.write(fragment)
+        return ''.join(parts)
 
-            self.outputFile.write('   call suite%addTest(makeCustomTest(' +
-                                  args + testParameterArg + '))\n')
-            if 'cases' in locals() or 'testParameters' in locals():
-                self.outputFile.write('   end do\n')
+    # The rendered makeCustomTest text depends only on the test-parameter
+    # type, the constructor and the test-case type; cache it so runs over
+    # many .pf files with the same signature reuse the formatted block.
+    _makeCustomTestCache = {}
 
     def printMakeCustomTest(self, isMpiTestCase):
-        args = 'methodName, testMethod'
-        declareArgs = '#ifdef INTEL_13\n'
-        declareArgs += '      use pfunit_mod, only: testCase\n'
-        declareArgs += '#endif\n'
-        declareArgs += '      type (WrapUserTestCase) :: aTest\n'
-        declareArgs += '#ifdef INTEL_13\n'
-        declareArgs += '      target :: aTest\n'
-        declareArgs += '      class (WrapUserTestCase), pointer :: p\n'
-        declareArgs += '#endif\n'
-        declareArgs += '      character(len=*), intent(in) :: methodName\n'
-        declareArgs += '      procedure(userTestMethod) :: testMethod\n'
-
-        if 'testParameterType' in self.userTestCase:
-            args += ', testParameter'
-            declareArgs += '      type (' \
-                           + self.userTestCase['testParameterType'] \
-                           + '), intent(in) :: testParameter\n'
-
-        self.outputFile.write('   function makeCustomTest('
-                              + args + ') result(aTest)\n')
-        self.outputFile.write(declareArgs)
-
-        if 'constructor' in self.userTestCase:
-            if 'testParameterType' in self.userTestCase:
-                constructor = self.userTestCase['constructor'] \
-                              + '(testParameter)'
-            else:
-                constructor = self.userTestCase['constructor'] + '()'
-            self.outputFile.write('      aTest%' + self.userTestCase['type']
-                                  + ' = ' + constructor + '\n\n')
-
-        self.outputFile.write('      aTest%testMethodPtr => testMethod\n')
-
-        self.outputFile.write('#ifdef INTEL_13\n')
-        self.outputFile.write('      p => aTest\n')
-        self.outputFile.write('      call p%setName(methodName)\n')
-        self.outputFile.write('#else\n')
-        self.outputFile.write('      call aTest%setName(methodName)\n')
-        self.outputFile.write('#endif\n')
-
-        if 'testParameterType' in self.userTestCase:
-            fragment = '      call aTest%setTestParameter(testParameter)\n'
-            self.outputFile.write(fragment)
+        key = (self.userTestCase.get('testParameterType'),
+               self.userTestCase.get('constructor'),
+               self.userTestCase.get('type'))
+        text = self._makeCustomTestCache.get(key)
+        if text is not None:
+            self.outputFile.write(text)
+            return
+
+        hasTestParameter = key[0] is not None
+
+        if hasTestParameter:
+            args = 'methodName, testMethod, testParameter'
+            testParameterDecl = ''.join(('      type (', key[0],
+                                         '), intent(in) :: testParameter\n'))
+            setTestParameterLine \
+                = '      call aTest%setTestParameter(testParameter)\n'
+        else:
+            args = 'methodName, testMethod'
+            testParameterDecl = ''
+            setTestParameterLine = ''
+
+        constructor = key[1]
+        if constructor is not None:
+            constructorLine = ''.join(('      aTest%', key[2], ' = ',
+                                       constructor,
+                                       '(testParameter)\n\n'
+                                       if hasTestParameter else '()\n\n'))
+        else:
+            constructorLine = ''
 
-        self.outputFile.write('   end function makeCustomTest\n')
+        text = makeCustomTestTemplate.format(
+            args=args,
+            testParameterDecl=testParameterDecl,
+            constructorLine=constructorLine,
+            setTestParameterLine=setTestParameterLine)
+        self._makeCustomTestCache[key] = text
+        self.outputFile.write(text)
 
     def makeWrapperModule(self):
         # -----------------------------------------------------------
         # ! Start here
+
+        # Computed once here; addUserTestMethod would otherwise rescan the
+        # test-method list for every method it emits.
+        self._isMpiTestCase = ('npRequests' in self.userTestCase
+                               or any('npRequests' in testMethod
+                                      for testMethod in self.userTestMethods))
+
+        # The test-case-wide setUp/tearDown defaults are fixed once parsing
+        # is done; build the argument suffixes here instead of once per
+        # emitted test method.
+        if 'setUp' in self.userTestCase:
+            self._defaultSetUpArg = ', ' + self.userTestCase['setUp']
+        else:
+            self._defaultSetUpArg = ''
+        if 'tearDown' in self.userTestCase:
+            self._defaultTearDownArg = ', ' + self.userTestCase['tearDown']
+        else:
+            self._defaultTearDownArg = ''
+
+        # Most .pf files are plain suites: no user test case, no MPI and no
+        # per-method overrides.  Detect that shape once so the suite loop
+        # can take the branch-free fast path in addVanillaTestMethod.
+        self._isVanilla = ('type' not in self.userTestCase
+                           and not self._isMpiTestCase
+                           and not any('cases' in testMethod
+                                       or 'testParameters' in testMethod
+                                       or 'setUp' in testMethod
+                                       or 'tearDown' in testMethod
+                                       or 'type' in testMethod
+                                       for testMethod in self.userTestMethods))
+        self._vanillaSuffix = self._defaultSetUpArg \
+            + self._defaultTearDownArg + '))\n'
+
+        hasUserType = 'type' in self.userTestCase
+        isMpiTestCase = self._isMpiTestCase
+
         self.printHeader()
 
-        if 'type' in self.userTestCase:
+        if hasUserType:
             self.printWrapUserTestCase()
 
         self.outputFile.write('contains\n\n')
 
-        if 'type' in self.userTestCase:
+        if hasUserType:
             self.printRunMethod()
 
-        if 'type' in self.userTestCase:
-            found = any('npRequests' in testMethod
-                        for testMethod in self.userTestMethods)
-            isMpiTestCase = 'npRequests' in self.userTestCase
-            isMpiTestCase = isMpiTestCase or found
             if isMpiTestCase and 'testParameterType' not in self.userTestCase:
                 self.userTestCase['testParameterType'] = 'MpiTestParameter'
 
@@ -1010,8 +1048,10 @@ class Parser():
         self.printMakeSuite()
 
     def final(self):
-        self.inputFile.close()
-        self.outputFile.close()
+        # Safe to call more than once, e.g. from a finally clause after an
+        # earlier explicit close.
+        if not self.outputFile.closed:
+            self.outputFile.close()
 
 
 def process_cli():
@@ -1040,6 +1080,10 @@ if __name__ == "__main__":
     source_filename, target_filename, use_markers = process_cli()
     print("Processing file", source_filename)
     p = Parser(source_filename, target_filename, use_markers)
-    p.run()
-    p.final()
+    try:
+        p.run()
+    finally:
+        # Always close (and thereby flush) the buffered output, also when
+        # a malformed .pf file makes run() raise.
+        p.final()
     print(" ... Done.  Results in", target_filename)